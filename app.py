@@ -1,11 +1,22 @@
 # Image Downsampler App
 
 import os
-import mimetypes
 import logging
+from logging.handlers import MemoryHandler
 import io
+import functools
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, wait
+import PIL
 from PIL import Image
 
+# OpenCV is optional; without it all resizing goes through Pillow
+try:
+    import cv2
+    import numpy as np
+except ImportError:
+    cv2 = None
+
 # Increase Pillow max pixel support
 Image.MAX_IMAGE_PIXELS = 209715200  # 200MB
 
@@ -18,22 +29,84 @@ SOURCE_DIR = "./tmp/source"
 RESAMPLING_FILTER = Image.LANCZOS
 JPEG_QUALITY = 98
 DEFAULT_DPI = 300
+WORKER_PROCESSES = os.cpu_count()
+POOL_CHUNKSIZE = 4
+POOL_MAX_TASKS_PER_CHILD = 8  # Tasks are chunks of POOL_CHUNKSIZE files
+WRITER_THREADS = 2
+RESIZE_TILE_BYTES = 32 * 1024 * 1024  # ~L3 cache
+# Bytes per pixel in Pillow's in-memory layout for the modes resized in tiles
+TILED_RESIZE_BYTES_PER_PIXEL = {'L': 1, 'RGB': 4, 'CMYK': 4}
+REDUCING_GAP = 3.0
+
+# Target directory for each DPI
+_DPI_DIRS = {dpi: f"{SOURCE_DIR}_images_{dpi}dpi" for dpi in DPIS}
 
 # Feature Flags
 ENABLE_CHECK_MAX_BYTES = True
 ENABLE_CHECK_MIN_MAX_LENGTH = True
 ENABLE_JPEG_QUALITY = True
+ENABLE_JPEG_DRAFT = True
+ENABLE_JPEG_OPTIMIZE = True
+ENABLE_TILED_RESIZE = True
+ENABLE_OPENCV_RESIZE = True
+ENABLE_REDUCE_PREFILTER = True
 
-# Supported image formats based on MIME types
-SUPPORTED_FORMATS = ['image/jpeg', 'image/png', 'image/tiff', 'image/bmp']
+# Supported image formats based on file extension
+SUPPORTED_EXTENSIONS = frozenset({'.jpg', '.jpeg', '.png', '.tif', '.tiff', '.bmp'})
 
 # Set up logging
 LOG_FILE = "image_resize.log"
+LOG_BUFFER_CAPACITY = 256
+
+# Per-process background writer, see get_writer()
+_writer = None
+
+class BatchingMemoryHandler(MemoryHandler):
+    """MemoryHandler whose flush writes all buffered records to the target stream in a single
+    write. MemoryHandler.flush() hands records to the target one at a time, and its emit()
+    writes and flushes the stream for each record."""
+
+    def flush(self):
+        with self.lock:
+            if not self.buffer or self.target is None:
+                return
+            try:
+                with self.target.lock:
+                    self.target.stream.write(''.join(self.target.format(record) + self.target.terminator
+                                                     for record in self.buffer))
+                    self.target.stream.flush()
+            except Exception:
+                self.handleError(self.buffer[0])
+            finally:
+                self.buffer.clear()
 
 def init_logger():
     delete_file_if_exists(LOG_FILE)
+    init_worker_logger()
+
+def init_worker_logger():
+    """Configure logging in a worker process. Appends to LOG_FILE; no-op if already configured.
+    Records are buffered and written in batches (errors are written immediately)."""
+    root_logger = logging.getLogger()
+    if root_logger.handlers:
+        return
+
     logging.basicConfig(filename=LOG_FILE, level=logging.INFO,
                         format='%(asctime)s - %(levelname)s - %(message)s')
+    root_logger.handlers = [BatchingMemoryHandler(LOG_BUFFER_CAPACITY, target=root_logger.handlers[0])]
+
+def init_worker():
+    """Pool initializer. Each worker process already has a core to itself, so keep OpenCV from
+    starting its own per-core thread pool on top of that."""
+    init_worker_logger()
+    if cv2 is not None:
+        cv2.setNumThreads(1)
+
+def flush_logs():
+    """Write out buffered log records. Pool workers exit without running atexit handlers,
+    so they flush after every file."""
+    for handler in logging.getLogger().handlers:
+        handler.flush()
 
 def delete_file_if_exists(file_path):
     try:
@@ -46,6 +119,11 @@ def delete_file_if_exists(file_path):
 def split_file_name(file_path):
     return os.path.splitext(os.path.basename(file_path))
 
+def check_pillow_simd():
+    """Warn if the installed PIL is not a Pillow-SIMD build (versioned as x.y.z.postN)."""
+    if "post" not in PIL.__version__:
+        logging.warning(f"Pillow-SIMD not detected (PIL {PIL.__version__}); resizing will use the slower non-SIMD build")
+
 def get_original_dpi(image):
     """Extract the original DPI from the image metadata. Default to DEFAULT_DPI if not found."""
     dpi = (DEFAULT_DPI, DEFAULT_DPI)
@@ -55,33 +133,145 @@ def get_original_dpi(image):
         logging.warning(f"Failed to read DPI from source image metadata: {e}")    
     return max(dpi)  # Return the higher value for scaling
 
+@functools.lru_cache(maxsize=4096)
+def calculate_target_size(original_width, original_height, original_dpi, dpi):
+    """Calculate the (width, height) of an image of the given size and DPI scaled to the target DPI."""
+    dpi_scale_factor = dpi / original_dpi
+
+    if original_width > original_height:  #  Landscape
+        new_width = int(original_width * dpi_scale_factor)
+        new_height = int(new_width * (original_height / original_width))
+    else:  #  Portrait or square
+        new_height = int(original_height * dpi_scale_factor)
+        new_width = int(new_height * (original_width / original_height))
+
+    if ENABLE_CHECK_MIN_MAX_LENGTH:
+        # Resize the image if its longest side is longer than MAX_PIXEL_LENGTH or shorter than MIN_PIXEL_LENGTH
+        scale_factor = min(MAX_PIXEL_LENGTH / max(new_width, new_height), 1)
+        new_width = max(int(new_width * scale_factor), MIN_PIXEL_LENGTH)
+        new_height = max(int(new_height * scale_factor), MIN_PIXEL_LENGTH)
+
+    return new_width, new_height
+
+def apply_jpeg_draft(img):
+    """Let libjpeg decode a JPEG at a reduced scale (1/2, 1/4 or 1/8) that is still at least
+    twice the largest target size. Must be called before the image is loaded. Returns the
+    original (pre-draft) size, which target sizes must be calculated from."""
+    original_size = img.size
+    if not ENABLE_JPEG_DRAFT or img.format != 'JPEG':
+        return original_size
+
+    try:
+        original_dpi = get_original_dpi(img)
+    except Exception:
+        # No usable DPI metadata: decode at full size and leave reporting to resize_image_from_pil
+        return original_size
+
+    try:
+        target_sizes = [calculate_target_size(*original_size, original_dpi, dpi) for dpi in DPIS if dpi <= original_dpi]
+        if target_sizes:
+            max_width = max(width for width, _ in target_sizes)
+            max_height = max(height for _, height in target_sizes)
+            img.draft(img.mode, (max_width * 2, max_height * 2))
+    except Exception as e:
+        logging.warning(f"Failed to enable draft mode for image {img.filename}: {str(e)}")
+
+    return original_size
+
+def resize_tiled(img, size, reducing_gap=None):
+    """Resize img in horizontal strips whose source rows fit within RESIZE_TILE_BYTES, so the
+    vertical filter pass reads from cache rather than DRAM. Pillow samples the filter support
+    from outside the box argument, so strips join seamlessly without explicit overlap."""
+    new_width, new_height = size
+    src_width, src_height = img.width, img.height
+
+    if reducing_gap is not None:
+        # Box-reduce the whole image once, as resize() does for a full frame. Reducing each
+        # strip's box separately puts every strip on its own grid and leaves visible seams.
+        factor_x = int(src_width / new_width / reducing_gap) or 1
+        factor_y = int(src_height / new_height / reducing_gap) or 1
+        if factor_x > 1 or factor_y > 1:
+            img = img.reduce((factor_x, factor_y))
+            # The last reduced row/column may be partial, so keep the fractional source extent
+            src_width, src_height = src_width / factor_x, src_height / factor_y
+
+    scale_y = src_height / new_height
+    bytes_per_pixel = TILED_RESIZE_BYTES_PER_PIXEL[img.mode]
+    tile_rows = max(1, int(RESIZE_TILE_BYTES / (bytes_per_pixel * img.width * scale_y)))
+
+    resized_img = Image.new(img.mode, size)
+    for y0 in range(0, new_height, tile_rows):
+        y1 = min(y0 + tile_rows, new_height)
+        strip = img.resize((new_width, y1 - y0), RESAMPLING_FILTER, box=(0, y0 * scale_y, src_width, y1 * scale_y))
+        resized_img.paste(strip, (0, y0))
+    return resized_img
+
+def resize_opencv(img, size):
+    """Downscale img with OpenCV's area interpolation."""
+    resized_arr = cv2.resize(np.asarray(img), size, interpolation=cv2.INTER_AREA)
+    resized_img = Image.fromarray(resized_arr)
+    # fromarray() starts with empty info; keep the ICC profile and other metadata like resize() does
+    resized_img.info = img.info.copy()
+    return resized_img
+
+def resample_image(img, size):
+    """Resample img to size. Pure downscales go through OpenCV when available; otherwise
+    Pillow is used, tiling the pass for images too large to stay in cache."""
+    # Nothing to resample, e.g. when the source is already within the pixel length limits.
+    # Copy so the caller never holds on to (or saves) the source image itself.
+    if size == img.size:
+        return img.copy()
+
+    if (ENABLE_OPENCV_RESIZE and cv2 is not None and img.mode in ('L', 'RGB')
+            and size[0] <= img.width and size[1] <= img.height):
+        return resize_opencv(img, size)
+
+    # For pure downscales box-reduce by an integer factor first (as thumbnail() does), choosing
+    # the largest factor that keeps the LANCZOS pass at least REDUCING_GAP times the target
+    reducing_gap = None
+    if ENABLE_REDUCE_PREFILTER and size[0] <= img.width and size[1] <= img.height:
+        reducing_gap = REDUCING_GAP
+
+    # Alpha and palette modes are converted internally by resize(), which would repeat per strip
+    if (ENABLE_TILED_RESIZE and img.mode in TILED_RESIZE_BYTES_PER_PIXEL
+            and TILED_RESIZE_BYTES_PER_PIXEL[img.mode] * img.width * img.height > RESIZE_TILE_BYTES):
+        return resize_tiled(img, size, reducing_gap)
+    return img.resize(size, RESAMPLING_FILTER, reducing_gap=reducing_gap)
+
+def resize_image_from_pil(img, dpi, resample_from=None, original_size=None):
+    """Resize an already opened image to the given DPI. Returns None if the image is skipped.
+
+    Target dimensions are computed from original_size (defaults to img.size; pass the
+    pre-draft size for drafted JPEGs). If resample_from (e.g. a previously resized, larger
+    tier) is at least as large as the target, it is resampled instead of img.
+    """
+    image_path = getattr(img, 'filename', '')
+    try:
+        original_width, original_height = original_size or img.size
+        original_dpi = get_original_dpi(img)
+
+        if dpi > original_dpi:
+            logging.info(f"Skipping image {image_path} at {dpi}dpi (original DPI: {original_dpi})")
+            return None
+
+        new_width, new_height = calculate_target_size(original_width, original_height, original_dpi, dpi)
+
+        resample_src = img
+        if resample_from is not None and resample_from.width >= new_width and resample_from.height >= new_height:
+            resample_src = resample_from
+
+        resized_img = resample_image(resample_src, (new_width, new_height))
+        return resized_img
+
+    except Exception as e:
+        logging.error(f"Unexpected error resizing image {image_path}: {str(e)}")
+        return None
+
 def resize_image(image_path, dpi):
     try:
         with Image.open(image_path) as img:
-            original_width, original_height = img.size
-            original_dpi = get_original_dpi(img)
-            
-            if dpi > original_dpi:
-                logging.info(f"Skipping image {image_path} at {dpi}dpi (original DPI: {original_dpi})")
-                return None
-
-            dpi_scale_factor = dpi / original_dpi
-
-            if original_width > original_height:  #  Landscape
-                new_width = int(original_width * dpi_scale_factor)
-                new_height = int(new_width * (original_height / original_width))
-            else:  #  Portrait or square
-                new_height = int(original_height * dpi_scale_factor)
-                new_width = int(new_height * (original_width / original_height))
-
-            if ENABLE_CHECK_MIN_MAX_LENGTH:
-                # Resize the image if its longest side is longer than MAX_PIXEL_LENGTH or shorter than MIN_PIXEL_LENGTH
-                scale_factor = min(MAX_PIXEL_LENGTH / max(new_width, new_height), 1)
-                new_width = max(int(new_width * scale_factor), MIN_PIXEL_LENGTH)
-                new_height = max(int(new_height * scale_factor), MIN_PIXEL_LENGTH)
-
-            resized_img = img.resize((new_width, new_height), RESAMPLING_FILTER)
-            return resized_img
+            original_size = apply_jpeg_draft(img)
+            return resize_image_from_pil(img, dpi, original_size=original_size)
 
     except IOError as e:
         logging.error(f"Failed to open image {image_path}: {str(e)}")
@@ -90,77 +280,114 @@ def resize_image(image_path, dpi):
         logging.error(f"Unexpected error resizing image {image_path}: {str(e)}")
         return None
 
-def save_resized_image(resized_img, original_file_path, dpi):
+def get_save_params(file_ext, dpi):
+    """Build the encoder parameters for saving a resized image with the given extension."""
+    save_params = {'dpi': (dpi, dpi)}
+    if file_ext.lower() in ['.jpg', '.jpeg']:
+        if ENABLE_JPEG_QUALITY:
+            save_params['quality'] = JPEG_QUALITY
+        if ENABLE_JPEG_OPTIMIZE:
+            # Optimized Huffman tables and progressive coding give smaller files at the same quality
+            save_params.update(optimize=True, progressive=True)
+    return save_params
+
+def encode_and_save(resized_img, original_file_path, dpi):
+    """Encode the resized image once in memory, check its size and write the same bytes to disk.
+    Returns the encoded size in bytes, or None on failure."""
     try:
         # Split file name and extension using the helper function
         file_name, file_ext = split_file_name(original_file_path)
-        target_dir = f"{SOURCE_DIR}_images_{dpi}dpi"
-        if not os.path.exists(target_dir):
-            os.makedirs(target_dir)
+        new_file_path = f"{_DPI_DIRS[dpi]}{os.sep}{file_name}_{dpi}dpi{file_ext}"
+
+        # Map the extension to its Pillow format, e.g. '.jpg' -> 'JPEG', '.tif' -> 'TIFF'
+        image_format = Image.registered_extensions()[file_ext.lower()]
+        img_io = io.BytesIO()
+        resized_img.save(img_io, format=image_format, **get_save_params(file_ext, dpi))
+        img_size = img_io.tell()
 
-        new_file_name = f"{file_name}_{dpi}dpi{file_ext}"
-        new_file_path = os.path.join(target_dir, new_file_name)
+        if ENABLE_CHECK_MAX_BYTES and img_size > MAX_TOTAL_BYTES:
+            logging.warning(f"Image {file_name}{file_ext} at {dpi}dpi exceeds max size: {img_size} bytes (max {MAX_TOTAL_BYTES} bytes).")
 
-        save_params = {'dpi': (dpi, dpi)}
-        if ENABLE_JPEG_QUALITY and file_ext.lower() in ['.jpg', '.jpeg']:
-            save_params['quality'] = JPEG_QUALITY
-        
-        resized_img.save(new_file_path, **save_params)
+        with open(new_file_path, 'wb') as f:
+            # getbuffer() exposes the encoded bytes without copying them as getvalue() would
+            f.write(img_io.getbuffer())
         logging.info(f"Image saved: {new_file_path}")
-        
+        return img_size
+
     except OSError as e:
         logging.error(f"Failed to save image {original_file_path} at {dpi}dpi: {str(e)}")
+        return None
     except Exception as e:
         logging.error(f"Unexpected error saving image {original_file_path} at {dpi}dpi: {str(e)}")
+        return None
 
-# Updated check_image_size_in_memory function without file_name parameter
-def check_image_size_in_memory(resized_img, original_file_path, dpi):
-    try:
-        # Split file name and extension using the helper function
-        _, file_ext = split_file_name(original_file_path)
+def list_source_images():
+    """Yield the paths of supported image files in SOURCE_DIR."""
+    with os.scandir(SOURCE_DIR) as entries:
+        for entry in entries:
+            if not entry.is_file():
+                continue
 
-        # Determine the correct image format for saving in memory
-        img_io = io.BytesIO()
-        save_params = {'dpi': (dpi, dpi)}
-        if ENABLE_JPEG_QUALITY and file_ext.lower() in ['.jpg', '.jpeg']:
-            save_params['quality'] = JPEG_QUALITY
+            if os.path.splitext(entry.name)[1].lower() not in SUPPORTED_EXTENSIONS:
+                logging.debug(f"Skipped non-image file: {entry.path}")
+                continue
 
-        # Ensure the correct image format is passed when saving
-        image_format = file_ext.lstrip('.').upper()  # Convert extension to format
+            yield entry.path
 
-        if image_format == 'JPG':
-            image_format = 'JPEG'
+def get_writer():
+    """Return this process's background writer, creating it on first use (i.e. inside the worker)."""
+    global _writer
+    if _writer is None:
+        _writer = ThreadPoolExecutor(max_workers=WRITER_THREADS)
+    return _writer
 
-        resized_img.save(img_io, format=image_format, **save_params)
-        img_size = img_io.tell()
-        return img_size
-    except Exception as e:
-        logging.error(f"Error checking image size in memory for {original_file_path} at {dpi}dpi: {str(e)}")
-        return None
+def _process_one(file_path):
+    file_name = os.path.basename(file_path)
+    logging.info(f"Processing image: {file_name}")
 
-def process_images():
-    for file_name in os.listdir(SOURCE_DIR):
-        file_path = os.path.join(SOURCE_DIR, file_name)
+    # Encoding and writing happen on a background thread so the next tier can be
+    # resized while the previous one is being saved
+    pending_writes = []
 
-        mime_type, _ = mimetypes.guess_type(file_path)
-        if mime_type not in SUPPORTED_FORMATS:
-            logging.info(f"Skipped non-image file: {file_path}")
-            continue
+    # Decode the source once, then cascade from the largest to the smallest DPI,
+    # resampling each tier from the previous one instead of the full-size original
+    try:
+        with Image.open(file_path) as src:
+            original_size = apply_jpeg_draft(src)
+            src.load()
+            prev_img = None
 
-        logging.info(f"Processing image: {file_name}")
+            for dpi in sorted(DPIS, reverse=True):
+                resized_img = resize_image_from_pil(src, dpi, prev_img, original_size)
+                if resized_img is None:
+                    continue
+                prev_img = resized_img
 
-        for dpi in DPIS:
-            resized_img = resize_image(file_path, dpi)
-            if resized_img is None:
-                continue
+                pending_writes.append(get_writer().submit(encode_and_save, resized_img, file_path, dpi))
+
+    except IOError as e:
+        logging.error(f"Failed to open image {file_path}: {str(e)}")
+    except Exception as e:
+        logging.error(f"Unexpected error processing image {file_path}: {str(e)}")
+    finally:
+        wait(pending_writes)
+        flush_logs()
+
+def process_images():
+    # Create the target directories once up front rather than checking on every save
+    for target_dir in _DPI_DIRS.values():
+        os.makedirs(target_dir, exist_ok=True)
+
+    # Flush before forking so workers don't inherit (and duplicate) buffered records
+    flush_logs()
 
-            if ENABLE_CHECK_MAX_BYTES:
-                img_size = check_image_size_in_memory(resized_img, file_path, dpi)
-                if img_size is not None and img_size > MAX_TOTAL_BYTES:
-                    logging.warning(f"Image {file_name} at {dpi}dpi exceeds max size: {img_size} bytes (max {MAX_TOTAL_BYTES} bytes).")
-            
-            save_resized_image(resized_img, file_path, dpi)
+    # Files are independent, so process them in parallel across worker processes
+    with multiprocessing.Pool(WORKER_PROCESSES, initializer=init_worker,
+                              maxtasksperchild=POOL_MAX_TASKS_PER_CHILD) as pool:
+        for _ in pool.imap_unordered(_process_one, list_source_images(), chunksize=POOL_CHUNKSIZE):
+            pass
 
 if __name__ == "__main__":
     init_logger()
+    check_pillow_simd()
     process_images()